@@ -1,5 +1,6 @@
 import os
 import re
+import hashlib
 import calendar
 import datetime as dt
 
@@ -75,9 +76,91 @@ def decode_periodo(periodo_raw):
     return periodo_codigo, periodo_desc, data_ref
 
 
-def parse_metrics(full_text):
+# Tipos de lançamento extraídos de cada bloco de produto.
+# O detalhe guarda apenas as duas linhas usadas pelo resumo (entrada de produção e
+# estoque físico atual); as demais linhas de Tipo Lançamento do bloco não são lidas.
+TIPO_PRODUCAO = "producao"
+TIPO_ESTOQUE_ATUAL = "estoque_atual"
+
+
+def unidade_esperada(prod):
+    """
+    Unidade de medida aceita para o produto (m³ para etanol, t para cana e açúcar).
+    Para outros produtos retorna None e vale a unidade da primeira linha lida.
+    """
+    if "Etanol -" in prod:
+        return "m³"
+    if "Cana moída -" in prod or "Açúcar -" in prod:
+        return "t"
+    return None
+
+
+def parse_detalhes(full_text):
+    """
+    Percorre os blocos de produtos no texto do PDF e extrai, para cada produto,
+    a produção do período e o estoque físico atual.
+    Retorna uma lista de dicts (produto, tipo_lancamento, unidade_medida, valor),
+    com no máximo uma entrada por (produto, tipo_lancamento).
+    """
+    detalhes = {}
+
+    def clean_value(match):
+        """Remove pontos de milhar e substitui vírgula decimal por ponto."""
+        return float(match.group(2).replace(".", "").replace(",", "."))
+
+    def unidade_valida(prod, key, unidade):
+        """Descarta linhas em unidade diferente da esperada ou da já registrada."""
+        esperada = unidade_esperada(prod)
+        if esperada is not None:
+            return unidade == esperada
+        return key not in detalhes or detalhes[key]["unidade_medida"] == unidade
+
+    chunks = full_text.split("Matéria prima / Produto / Subproduto")
+    # O primeiro pedaço é apenas o cabeçalho, ignoramos
+    for chunk in chunks[1:]:
+        parts = chunk.split("Tipo Lançamento Valor")
+        prod = parts[0].strip().replace("\n", " ")
+        body = parts[1] if len(parts) > 1 else ""
+        lines = [ln.strip() for ln in body.split("\n") if ln.strip()]
+
+        for ln in lines:
+            # Produção: soma todas as entradas de produção do produto
+            m = re.search(r"Entrada (t|m³) ?([0-9\.\,]+) Produção", ln)
+            key = (prod, TIPO_PRODUCAO)
+            if m and unidade_valida(prod, key, m.group(1)):
+                if key not in detalhes:
+                    detalhes[key] = {
+                        "produto": prod,
+                        "tipo_lancamento": TIPO_PRODUCAO,
+                        "unidade_medida": m.group(1),
+                        "valor": 0.0,
+                    }
+                detalhes[key]["valor"] += clean_value(m)
+
+            # Estoque: açúcares somam todas as linhas do produto;
+            # demais produtos (etanol) ficam com o último valor lido
+            m = re.search(r"Estoque físico do período atual (t|m³) ?([0-9\.\,]+)", ln)
+            key = (prod, TIPO_ESTOQUE_ATUAL)
+            if m and unidade_valida(prod, key, m.group(1)):
+                valor = clean_value(m)
+                if "Açúcar -" in prod and key in detalhes:
+                    detalhes[key]["valor"] += valor
+                else:
+                    # Reinsere a chave para que a ordem reflita a última leitura
+                    detalhes.pop(key, None)
+                    detalhes[key] = {
+                        "produto": prod,
+                        "tipo_lancamento": TIPO_ESTOQUE_ATUAL,
+                        "unidade_medida": m.group(1),
+                        "valor": valor,
+                    }
+
+    return list(detalhes.values())
+
+
+def parse_metrics(detalhes):
     """
-    Percorre os blocos de produtos no texto do PDF e extrai as métricas.
+    Agrega o detalhe por produto (ver parse_detalhes) nas métricas do resumo quinzenal.
     """
     result = {
         "cana_propria_t": 0.0,
@@ -90,72 +173,42 @@ def parse_metrics(full_text):
         "estoque_acucar_total_t": 0.0, # Soma do estoque de todos os açúcares
     }
 
-    chunks = full_text.split("Matéria prima / Produto / Subproduto")
-    # O primeiro pedaço é apenas o cabeçalho, ignoramos
-    for chunk in chunks[1:]:
-        parts = chunk.split("Tipo Lançamento Valor")
-        prod = parts[0].strip().replace("\n", " ")
-        body = parts[1] if len(parts) > 1 else ""
-        lines = [ln.strip() for ln in body.split("\n") if ln.strip()]
-
-        def clean_value(match):
-            """Remove pontos de milhar e substitui vírgula decimal por ponto."""
-            return float(match.group(1).replace(".", "").replace(",", "."))
+    for d in detalhes:
+        prod = d["produto"]
+        producao = d["tipo_lancamento"] == TIPO_PRODUCAO
+        estoque = d["tipo_lancamento"] == TIPO_ESTOQUE_ATUAL
+        em_t = d["unidade_medida"] == "t"
+        em_m3 = d["unidade_medida"] == "m³"
 
         # --- Cana moída ---
         if "Cana moída - Própria" in prod:
-            for ln in lines:
-                m = re.search(r"Entrada t ?([0-9\.\,]+) Produção", ln)
-                if m:
-                    result["cana_propria_t"] += clean_value(m)
+            if producao and em_t:
+                result["cana_propria_t"] += d["valor"]
 
         elif "Cana moída - Terceiros" in prod:
-            for ln in lines:
-                m = re.search(r"Entrada t ?([0-9\.\,]+) Produção", ln)
-                if m:
-                    result["cana_terceiros_t"] += clean_value(m)
+            if producao and em_t:
+                result["cana_terceiros_t"] += d["valor"]
 
         # --- Etanol ---
         elif "Etanol - Anidro" in prod:
-            for ln in lines:
-                # Produção
-                if "Entrada m³" in ln and "Produção" in ln:
-                    m = re.search(r"Entrada m³ ?([0-9\.\,]+) Produção", ln)
-                    if m:
-                        result["etanol_anidro_prod"] += clean_value(m)
-                # Estoque
-                if "Estoque físico do período atual m³" in ln:
-                    m = re.search(r"Estoque físico do período atual m³ ?([0-9\.\,]+)", ln)
-                    if m:
-                        result["etanol_anidro_estoque"] = clean_value(m)
+            if producao and em_m3:
+                result["etanol_anidro_prod"] += d["valor"]
+            if estoque and em_m3:
+                result["etanol_anidro_estoque"] = d["valor"]
 
         elif "Etanol - Hidratado" in prod:
-            for ln in lines:
-                # Produção
-                if "Entrada m³" in ln and "Produção" in ln:
-                    m = re.search(r"Entrada m³ ?([0-9\.\,]+) Produção", ln)
-                    if m:
-                        result["etanol_hidratado_prod"] += clean_value(m)
-                # Estoque
-                if "Estoque físico do período atual m³" in ln:
-                    m = re.search(r"Estoque físico do período atual m³ ?([0-9\.\,]+)", ln)
-                    if m:
-                        result["etanol_hidratado_estoque"] = clean_value(m)
+            if producao and em_m3:
+                result["etanol_hidratado_prod"] += d["valor"]
+            if estoque and em_m3:
+                result["etanol_hidratado_estoque"] = d["valor"]
 
         # --- Açúcares (Cristal, VHP, etc.) ---
         # Usa 'Açúcar -' pois pode ser Cristal, VHP, etc.
         elif "Açúcar -" in prod:
-            for ln in lines:
-                # Produção de Açúcar (Soma a produção de todos os tipos)
-                if "Entrada t" in ln and "Produção" in ln:
-                    m = re.search(r"Entrada t ?([0-9\.\,]+) Produção", ln)
-                    if m:
-                        result["acucar_total_t"] += clean_value(m)
-                # Estoque de Açúcar (Soma o estoque de todos os tipos)
-                if "Estoque físico do período atual t" in ln:
-                    m = re.search(r"Estoque físico do período atual t ?([0-9\.\,]+)", ln)
-                    if m:
-                        result["estoque_acucar_total_t"] += clean_value(m)
+            if producao and em_t:
+                result["acucar_total_t"] += d["valor"]
+            if estoque and em_t:
+                result["estoque_acucar_total_t"] += d["valor"]
 
     return result
 
@@ -164,7 +217,8 @@ def parse_pdf(pdf_path):
     """Função principal para extrair todos os dados de um PDF e formatar a linha."""
     full = extract_full_text(pdf_path)
     safra, periodo_raw, produtor_cod, produtor_nome = parse_header(full)
-    metrics = parse_metrics(full)
+    detalhes = parse_detalhes(full)
+    metrics = parse_metrics(detalhes)
 
     periodo_codigo, periodo_desc, data_ref = decode_periodo(periodo_raw)
 
@@ -180,6 +234,7 @@ def parse_pdf(pdf_path):
         "unidade_apelido": apelido,
         "produtor_cod": produtor_cod,
         "produtor_nome": produtor_nome,
+        "detalhes": detalhes,
     }
     row.update(metrics)
 
@@ -274,66 +329,547 @@ def upsert_resumo(row, safra_periodo_id, unidade_id, conn):
     })
 
 
-# ---------- Pipeline principal: pasta PDFs -> CSV -> DB ----------
+def delete_detalhes(chaves, conn, batch_size=500):
+    """
+    Remove o detalhe já gravado para cada (safra_periodo_id, unidade_id) informado,
+    para que produtos ausentes no PDF reprocessado não permaneçam no banco.
+    """
+    chaves = list(dict.fromkeys(chaves))
+    for inicio in range(0, len(chaves), batch_size):
+        lote = chaves[inicio:inicio + batch_size]
+        values = []
+        params = {}
+        for i, (safra_periodo_id, unidade_id) in enumerate(lote):
+            values.append(f"(:safra_periodo_id_{i}, :unidade_id_{i})")
+            params[f"safra_periodo_id_{i}"] = safra_periodo_id
+            params[f"unidade_id_{i}"] = unidade_id
+
+        sql = text(f"""
+            DELETE FROM fato_detalhe_quinzena
+            WHERE (safra_periodo_id, unidade_id) IN ({", ".join(values)});
+        """)
+        conn.execute(sql, params)
+
+
+def upsert_detalhes(detalhes, conn, batch_size=500):
+    """
+    Insere ou atualiza (UPSERT) as linhas de fato_detalhe_quinzena em lotes,
+    usando um único INSERT com múltiplos VALUES por lote.
+    Cada item deve conter safra_periodo_id, unidade_id e os campos de parse_detalhes.
+    """
+    # O mesmo INSERT não pode atualizar a mesma chave duas vezes: prevalece o último
+    unicos = {}
+    for d in detalhes:
+        key = (d["safra_periodo_id"], d["unidade_id"], d["produto"], d["tipo_lancamento"])
+        unicos[key] = d
+    detalhes = list(unicos.values())
+
+    for inicio in range(0, len(detalhes), batch_size):
+        lote = detalhes[inicio:inicio + batch_size]
+        values = []
+        params = {}
+        for i, d in enumerate(lote):
+            values.append(
+                f"(:safra_periodo_id_{i}, :unidade_id_{i}, :produto_{i}, "
+                f":tipo_lancamento_{i}, :unidade_medida_{i}, :valor_{i})"
+            )
+            params[f"safra_periodo_id_{i}"] = d["safra_periodo_id"]
+            params[f"unidade_id_{i}"] = d["unidade_id"]
+            params[f"produto_{i}"] = d["produto"]
+            params[f"tipo_lancamento_{i}"] = d["tipo_lancamento"]
+            params[f"unidade_medida_{i}"] = d["unidade_medida"]
+            params[f"valor_{i}"] = d["valor"]
+
+        sql = text(f"""
+            INSERT INTO fato_detalhe_quinzena (
+                safra_periodo_id, unidade_id, produto,
+                tipo_lancamento, unidade_medida, valor
+            ) VALUES {", ".join(values)}
+            ON CONFLICT (safra_periodo_id, unidade_id, produto, tipo_lancamento) DO UPDATE SET
+                unidade_medida = EXCLUDED.unidade_medida,
+                valor = EXCLUDED.valor,
+                updated_at = now();
+        """)
+        conn.execute(sql, params)
+
+
+# ---------- Validação do lote (antes de qualquer gravação) ----------
+
+# Colunas que identificam uma linha do resumo quinzenal
+CHAVES = ["safra", "periodo_codigo", "data_referencia", "unidade_apelido"]
+# Chave usada na checagem de duplicatas (uma linha por safra, período e unidade)
+CHAVES_DUPLICATA = ["safra", "periodo_codigo", "unidade_apelido"]
+
+# Colunas numéricas gravadas em fato_resumo_quinzena
+METRICAS = [
+    "cana_propria_t", "cana_terceiros_t", "cana_total_t",
+    "acucar_total_t", "etanol_total_m3",
+    "estoque_acucar_total_t", "estoque_etanol_total_m3",
+]
+
+# Tolerância de arredondamento para cana_total_t = própria + terceiros
+TOLERANCIA_CANA = 0.001
+
+# Desvios padrão em relação ao histórico da unidade para sinalizar um outlier
+OUTLIER_DESVIOS = 4
+# Quinzenas mínimas no histórico da unidade para avaliar outliers
+OUTLIER_MIN_HISTORICO = 6
+
+
+def load_historico(conn):
+    """Carrega média, desvio padrão e quantidade de quinzenas de cada métrica por unidade."""
+    stats = ",\n            ".join(
+        f"AVG(frq.{c}) AS {c}_media, STDDEV_SAMP(frq.{c}) AS {c}_desvio" for c in METRICAS
+    )
+    sql = text(f"""
+        SELECT
+            u.apelido AS unidade_apelido,
+            COUNT(*)  AS n_quinzenas,
+            {stats}
+        FROM fato_resumo_quinzena frq
+        JOIN unidade_produtora u ON u.id = frq.unidade_id
+        GROUP BY u.apelido;
+    """)
+    return pd.read_sql(sql, conn)
+
 
-def process_folder(pdf_folder, csv_output_path):
+def rotulo(r):
+    """Identifica uma linha do lote nas mensagens de validação."""
+    return f"{r['safra']} {r['periodo_codigo']} {r['unidade_apelido']} ({r['arquivo']})"
+
+
+def validate_rows(df, chaves_carregadas=None):
     """
-    Processa todos os PDFs de uma pasta, gera o CSV e carrega no banco de dados.
+    Executa as checagens estruturais, vetorizadas e sem acesso ao banco, sobre o lote inteiro.
+    chaves_carregadas (opcional) mapeia (safra, periodo_codigo, unidade_apelido) já
+    carregadas por lotes anteriores para o arquivo de origem.
+    Retorna a lista de erros; qualquer erro impede a gravação.
     """
-    rows = []
+    erros = []
+
+    # 1. Chaves nulas (cabeçalho não encontrado no PDF)
+    nulos = df[CHAVES].isna().any(axis=1)
+    for _, r in df[nulos].iterrows():
+        faltando = ", ".join(c for c in CHAVES if pd.isna(r[c]))
+        erros.append(f"{r['arquivo']}: chave(s) ausente(s): {faltando}")
+
+    # 2. Linhas duplicadas para a mesma (safra, periodo, unidade)
+    dup = df[~nulos & df.duplicated(CHAVES_DUPLICATA, keep=False)]
+    for _, grupo in dup.groupby(CHAVES_DUPLICATA):
+        arquivos = ", ".join(grupo["arquivo"])
+        erros.append(f"{rotulo(grupo.iloc[0])}: duplicada nos arquivos {arquivos}")
+
+    # Duplicadas em relação a lotes anteriores (modo backfill)
+    if chaves_carregadas:
+        chaves = pd.MultiIndex.from_frame(df[CHAVES_DUPLICATA])
+        repetidas = ~nulos & chaves.isin(list(chaves_carregadas))
+        for _, r in df[repetidas].iterrows():
+            origem = chaves_carregadas[tuple(r[c] for c in CHAVES_DUPLICATA)]
+            erros.append(f"{rotulo(r)}: duplicada, já carregada a partir de {origem}")
+
+    # 3. Valores negativos
+    negativos = df[METRICAS] < 0
+    for idx in df.index[negativos.any(axis=1)]:
+        colunas = ", ".join(negativos.columns[negativos.loc[idx]])
+        erros.append(f"{rotulo(df.loc[idx])}: valor(es) negativo(s) em {colunas}")
+
+    # 4. Consistência de cana_total_t
+    # parse_pdf deriva o total de própria + terceiros; esta checagem só protege
+    # DataFrames montados fora de parse_pdf
+    diff = (df["cana_total_t"] - df["cana_propria_t"] - df["cana_terceiros_t"]).abs()
+    for _, r in df[diff > TOLERANCIA_CANA].iterrows():
+        erros.append(
+            f"{rotulo(r)}: cana_total_t ({r['cana_total_t']}) difere de "
+            f"própria + terceiros ({r['cana_propria_t'] + r['cana_terceiros_t']})"
+        )
 
-    # 1. Extração e Transformação (PDFs -> Rows)
-    for fname in os.listdir(pdf_folder):
-        if not fname.lower().endswith(".pdf"):
-            continue
+    # 5. Produção sem cana moída: indica bloco de cana não encontrado no PDF
+    sem_cana = (df["cana_total_t"] == 0) & (
+        (df["acucar_total_t"] > 0) | (df["etanol_total_m3"] > 0)
+    )
+    for _, r in df[sem_cana].iterrows():
+        erros.append(f"{rotulo(r)}: produção de açúcar/etanol sem cana moída")
+
+    return erros
+
+
+def find_outliers(df, historico):
+    """
+    Compara as métricas do lote com o histórico da unidade (ver load_historico).
+    Retorna a lista de avisos; outliers não impedem a gravação.
+    """
+    avisos = []
+    if historico is None or historico.empty:
+        return avisos
+
+    dfh = df.merge(historico, on="unidade_apelido", how="left")
+    # Linhas com chave nula são erro estrutural, não outlier
+    com_historico = (
+        dfh[CHAVES].notna().all(axis=1)
+        & (dfh["n_quinzenas"].fillna(0) >= OUTLIER_MIN_HISTORICO)
+    )
+    for c in METRICAS:
+        media = dfh[f"{c}_media"].astype(float)
+        desvio = dfh[f"{c}_desvio"].astype(float)
+        fora = com_historico & (desvio > 0) & (
+            (dfh[c] - media).abs() > OUTLIER_DESVIOS * desvio
+        )
+        for _, r in dfh[fora].iterrows():
+            avisos.append(
+                f"{rotulo(r)}: {c} = {r[c]:,.3f} fora do histórico da unidade "
+                f"(média {r[f'{c}_media']:,.3f})"
+            )
+
+    return avisos
+
+
+# ---------- Checkpoint da carga em lotes (backfill) ----------
+
+def file_sha256(path):
+    """Calcula o sha256 do conteúdo do arquivo."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for bloco in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+def folder_prefix(pdf_folder):
+    """Caminho absoluto normalizado da pasta, usado como prefixo das chaves do checkpoint."""
+    return os.path.join(os.path.realpath(pdf_folder), "")
+
+
+def load_checkpoint(pdf_folder, conn):
+    """
+    Retorna {caminho: (sha256, (safra, periodo_codigo, unidade_apelido))}
+    dos arquivos da pasta já carregados em execuções anteriores do backfill.
+    """
+    result = conn.execute(text("""
+        SELECT arquivo, sha256, safra, periodo_codigo, unidade_apelido
+        FROM carga_checkpoint
+        WHERE left(arquivo, length(:pasta)) = :pasta;
+    """), {"pasta": folder_prefix(pdf_folder)})
+    return {r[0]: (r[1], (r[2], r[3], r[4])) for r in result}
+
+
+def reset_checkpoint(pdf_folder, conn):
+    """Apaga o checkpoint da pasta, forçando o backfill a recomeçar do primeiro arquivo."""
+    result = conn.execute(text("""
+        DELETE FROM carga_checkpoint
+        WHERE left(arquivo, length(:pasta)) = :pasta;
+    """), {"pasta": folder_prefix(pdf_folder)})
+    return result.rowcount
+
+
+def save_checkpoint(registros, conn):
+    """Registra os arquivos do lote na mesma transação da carga."""
+    sql = text("""
+        INSERT INTO carga_checkpoint (arquivo, sha256, safra, periodo_codigo, unidade_apelido)
+        VALUES (:arquivo, :sha256, :safra, :periodo_codigo, :unidade_apelido)
+        ON CONFLICT (arquivo) DO UPDATE
+        SET sha256 = EXCLUDED.sha256,
+            safra = EXCLUDED.safra,
+            periodo_codigo = EXCLUDED.periodo_codigo,
+            unidade_apelido = EXCLUDED.unidade_apelido,
+            processado_em = now();
+    """)
+    conn.execute(sql, registros)
+
+
+def load_checkpoint_resumo(pdf_folder, conn):
+    """
+    Lê de fato_resumo_quinzena as linhas já confirmadas dos arquivos da pasta
+    (via carga_checkpoint), nas colunas do CSV consolidado.
+    """
+    sql = text("""
+        SELECT DISTINCT
+            sp.safra,
+            sp.periodo_codigo,
+            sp.periodo_desc,
+            sp.data_referencia,
+            u.apelido AS unidade_apelido,
+            frq.cana_propria_t,
+            frq.cana_terceiros_t,
+            frq.cana_total_t,
+            frq.acucar_total_t,
+            frq.etanol_total_m3,
+            frq.estoque_acucar_total_t,
+            frq.estoque_etanol_total_m3
+        FROM carga_checkpoint ck
+        JOIN safra_periodo sp
+          ON sp.safra = ck.safra AND sp.periodo_codigo = ck.periodo_codigo
+        JOIN unidade_produtora u ON u.apelido = ck.unidade_apelido
+        JOIN fato_resumo_quinzena frq
+          ON frq.safra_periodo_id = sp.id AND frq.unidade_id = u.id
+        WHERE left(ck.arquivo, length(:pasta)) = :pasta
+        ORDER BY sp.data_referencia, u.apelido;
+    """)
+    df = pd.read_sql(sql, conn, params={"pasta": folder_prefix(pdf_folder)})
+    # Numeric chega como Decimal; float garante a vírgula decimal no CSV
+    df[METRICAS] = df[METRICAS].astype(float)
+    return df
+
+
+# ---------- Pipeline principal: pasta PDFs -> CSV -> DB ----------
+
+# Colunas gravadas no CSV consolidado
+CSV_COLUMNS = [
+    "safra", "periodo_codigo", "periodo_desc", "data_referencia", "unidade_apelido",
+    "cana_propria_t", "cana_terceiros_t", "cana_total_t",
+    "acucar_total_t", "etanol_total_m3",
+    "estoque_acucar_total_t", "estoque_etanol_total_m3"
+]
+
+
+def list_pdfs(pdf_folder):
+    """Lista os PDFs da pasta em ordem estável (necessária para retomar o backfill)."""
+    return sorted(f for f in os.listdir(pdf_folder) if f.lower().endswith(".pdf"))
+
+
+def parse_files(pdf_folder, fnames):
+    """Extrai as linhas dos PDFs informados. PDFs com erro são pulados."""
+    rows = []
+    for fname in fnames:
         pdf_path = os.path.join(pdf_folder, fname)
         print(f"Processando {pdf_path} ...")
-        
+
         try:
             row = parse_pdf(pdf_path)
+            row["arquivo"] = fname
             rows.append(row)
         except Exception as e:
             print(f"ERRO ao processar o PDF {fname}: {e}. Pulando...")
             continue
+    return rows
+
+
+def get_historico():
+    """Carrega o histórico para a checagem de outliers; None se o banco estiver indisponível."""
+    try:
+        with engine.connect() as conn:
+            return load_historico(conn)
+    except Exception as e:
+        print(f"Aviso: histórico indisponível ({e}). Checagem de outliers ignorada.")
+        return None
+
+
+def check_batch(df, historico_fn, chaves_carregadas=None):
+    """
+    Valida o lote e imprime o relatório. Retorna True se não houver erros.
+    historico_fn só é chamada (consulta ao banco) se as checagens estruturais passarem.
+    """
+    erros = validate_rows(df, chaves_carregadas)
+    for erro in erros:
+        print(f"ERRO: {erro}")
+    if erros:
+        print(f"Validação falhou com {len(erros)} erro(s).")
+        return False
+
+    for aviso in find_outliers(df, historico_fn()):
+        print(f"Aviso: {aviso}")
+    print(f"Validação concluída: {len(df)} linha(s) sem erros.")
+    return True
+
+
+def load_rows(df, conn):
+    """Carrega as linhas validadas (resumo e detalhe) usando a conexão/transação informada."""
+    chaves = []
+    detalhes = []
+    for _, r in df.iterrows():
+        safra_periodo_id = get_or_create_safra_periodo(r, conn)
+        unidade_id = get_or_create_unidade(r, conn)
+        upsert_resumo(r, safra_periodo_id, unidade_id, conn)
+        chaves.append((safra_periodo_id, unidade_id))
+
+        for d in r["detalhes"]:
+            detalhes.append({
+                **d,
+                "safra_periodo_id": safra_periodo_id,
+                "unidade_id": unidade_id,
+            })
+
+    # O detalhe é substituído por completo, como o resumo, para que SUM(detalhe) bata com ele
+    delete_detalhes(chaves, conn)
+    upsert_detalhes(detalhes, conn)
+
+
+def process_folder(pdf_folder, csv_output_path, dry_run=False):
+    """
+    Processa todos os PDFs de uma pasta, valida o lote, gera o CSV e carrega no banco de dados.
+    Com dry_run=True, apenas extrai e valida, sem gravar o CSV nem o banco.
+    """
+    # 1. Extração e Transformação (PDFs -> Rows)
+    rows = parse_files(pdf_folder, list_pdfs(pdf_folder))
 
     if not rows:
         print("Nenhum dado válido extraído. Verifique a pasta e os PDFs.")
-        return
+        return False
 
     df = pd.DataFrame(rows)
 
-    # 2. Geração do CSV consolidado
-    df_to_save = df[[
-        "safra", "periodo_codigo", "periodo_desc", "data_referencia", "unidade_apelido",
-        "cana_propria_t", "cana_terceiros_t", "cana_total_t",
-        "acucar_total_t", "etanol_total_m3",
-        "estoque_acucar_total_t", "estoque_etanol_total_m3"
-    ]]
-    df_to_save.to_csv(csv_output_path, index=False, encoding="utf-8", decimal=',')
+    # 2. Validação do lote inteiro antes de qualquer gravação
+    if not check_batch(df, get_historico):
+        print("Nada foi gravado.")
+        return False
+
+    if dry_run:
+        print("Dry-run: CSV e banco de dados não foram alterados.")
+        return True
+
+    # 3. Geração do CSV consolidado
+    df[CSV_COLUMNS].to_csv(csv_output_path, index=False, encoding="utf-8", decimal=',')
     print(f"CSV consolidado salvo em {csv_output_path}")
 
-    # 3. Carga no PostgreSQL (Load)
+    # 4. Carga no PostgreSQL (Load)
     with engine.begin() as conn:
-        for index, r in df.iterrows():
-            # Pular se houver dados essenciais faltando (embora o parse_pdf tente ser robusto)
-            if not r["safra"] or not r["unidade_apelido"]:
-                print(f"Aviso: Linha {index} sem Safra ou Apelido da Unidade. Pulando.")
-                continue
-
-            safra_periodo_id = get_or_create_safra_periodo(r, conn)
-            unidade_id = get_or_create_unidade(r, conn)
-            upsert_resumo(r, safra_periodo_id, unidade_id, conn)
+        load_rows(df, conn)
 
     print("Carga no PostgreSQL concluída com sucesso.")
+    return True
+
+
+def backfill_folder(pdf_folder, csv_output_path, chunk_size, dry_run=False,
+                    reset_checkpoint_first=False):
+    """
+    Processa a pasta em lotes de chunk_size PDFs, com uma transação por lote.
+    Cada lote registra seus arquivos (caminho e sha256) em carga_checkpoint na mesma
+    transação, de modo que uma nova execução retoma a partir do último lote confirmado
+    e recarrega PDFs cujo conteúdo mudou.
+    Ao final, o CSV é reescrito por inteiro a partir dos dados confirmados no banco,
+    de modo que uma carga nova e uma retomada produzem o mesmo arquivo.
+    """
+    if reset_checkpoint_first and not dry_run:
+        with engine.begin() as conn:
+            apagados = reset_checkpoint(pdf_folder, conn)
+        print(f"Checkpoint da pasta apagado ({apagados} arquivo(s)).")
+
+    if reset_checkpoint_first:
+        checkpoint = {}
+    else:
+        with engine.connect() as conn:
+            checkpoint = load_checkpoint(pdf_folder, conn)
+
+    # Arquivos já carregados com o mesmo conteúdo são pulados; as chaves deles
+    # alimentam a checagem de duplicatas entre lotes
+    arquivos = {}
+    chaves_carregadas = {}
+    pendentes = []
+    ja_carregados = 0
+    for fname in list_pdfs(pdf_folder):
+        # A chave usa o caminho dentro da pasta (não o destino de links simbólicos),
+        # para casar com o prefixo usado em load_checkpoint/reset_checkpoint
+        caminho = folder_prefix(pdf_folder) + fname
+        sha256 = file_sha256(os.path.join(pdf_folder, fname))
+        arquivos[fname] = (caminho, sha256)
+        if caminho in checkpoint and checkpoint[caminho][0] == sha256:
+            chaves_carregadas[checkpoint[caminho][1]] = fname
+            ja_carregados += 1
+        else:
+            pendentes.append(fname)
+
+    if ja_carregados:
+        print(f"Retomando backfill: {ja_carregados} arquivo(s) já carregado(s), "
+              f"{len(pendentes)} pendente(s).")
+    if not pendentes:
+        print("Nenhum PDF pendente.")
+
+    # O histórico é consultado uma vez, no primeiro lote que passar nas checagens estruturais
+    historico = {}
+
+    def historico_fn():
+        if "df" not in historico:
+            historico["df"] = get_historico()
+        return historico["df"]
+
+    total_lotes = (len(pendentes) + chunk_size - 1) // chunk_size
+
+    for n, inicio in enumerate(range(0, len(pendentes), chunk_size), start=1):
+        lote = pendentes[inicio:inicio + chunk_size]
+        print(f"Lote {n}/{total_lotes}: {len(lote)} PDF(s)")
+
+        rows = parse_files(pdf_folder, lote)
+        if not rows:
+            print("Nenhum dado válido extraído neste lote.")
+            continue
+
+        df = pd.DataFrame(rows)
+        if not check_batch(df, historico_fn, chaves_carregadas):
+            if dry_run:
+                print(f"Dry-run interrompido no lote {n}. Nada foi gravado.")
+            else:
+                print(f"Backfill interrompido no lote {n}. Os lotes anteriores já estão "
+                      "gravados; corrija os PDFs e execute novamente para retomar.")
+            return False
+
+        for _, r in df.iterrows():
+            chaves_carregadas[tuple(r[c] for c in CHAVES_DUPLICATA)] = r["arquivo"]
+
+        if dry_run:
+            continue
+
+        registros = [
+            {
+                "arquivo": arquivos[r["arquivo"]][0],
+                "sha256": arquivos[r["arquivo"]][1],
+                "safra": r["safra"],
+                "periodo_codigo": r["periodo_codigo"],
+                "unidade_apelido": r["unidade_apelido"],
+            }
+            for _, r in df.iterrows()
+        ]
+        with engine.begin() as conn:
+            load_rows(df, conn)
+            save_checkpoint(registros, conn)
+        print(f"Lote {n}/{total_lotes} confirmado no PostgreSQL.")
+
+    if dry_run:
+        print("Dry-run: CSV e banco de dados não foram alterados.")
+        return True
+
+    # CSV consolidado reconstruído do banco: inclui lotes de execuções anteriores
+    # e reflete apenas os valores atuais de PDFs revisados
+    with engine.connect() as conn:
+        df_csv = load_checkpoint_resumo(pdf_folder, conn)
+    df_csv[CSV_COLUMNS].to_csv(csv_output_path, index=False, encoding="utf-8", decimal=',')
+    print(f"CSV consolidado salvo em {csv_output_path} ({len(df_csv)} linha(s))")
+
+    print("Backfill concluído com sucesso.")
+    return True
 
 
 if __name__ == "__main__":
     import sys
+    import argparse
 
-    if len(sys.argv) != 3:
-        print("Uso: python process_quinzena_from_pdfs.py <pasta_pdfs> <arquivo_csv_saida>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="Extrai os PDFs quinzenais, gera o CSV consolidado e carrega no PostgreSQL."
+    )
+    parser.add_argument("pasta_pdfs")
+    parser.add_argument("arquivo_csv_saida")
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="apenas extrai e valida os PDFs, sem gravar CSV nem banco de dados",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, metavar="N",
+        help="modo backfill: confirma a carga a cada N PDFs e retoma do último lote confirmado",
+    )
+    parser.add_argument(
+        "--reset-checkpoint", action="store_true",
+        help="modo backfill: apaga o checkpoint da pasta e recomeça do primeiro PDF",
+    )
+    args = parser.parse_args()
 
-    folder = sys.argv[1]
-    csv_out = sys.argv[2]
-    process_folder(folder, csv_out)
\ No newline at end of file
+    if args.chunk_size is not None and args.chunk_size < 1:
+        parser.error("--chunk-size deve ser maior que zero")
+    if args.reset_checkpoint and not args.chunk_size:
+        parser.error("--reset-checkpoint requer --chunk-size")
+
+    if args.chunk_size:
+        ok = backfill_folder(
+            args.pasta_pdfs, args.arquivo_csv_saida, args.chunk_size, dry_run=args.dry_run,
+            reset_checkpoint_first=args.reset_checkpoint,
+        )
+    else:
+        ok = process_folder(args.pasta_pdfs, args.arquivo_csv_saida, dry_run=args.dry_run)
+    sys.exit(0 if ok else 1)